@@ -1,4 +1,5 @@
 from django.conf import settings as django_settings
+from django.core.signals import setting_changed
 
 from attrdict import AttrDict
 
@@ -21,16 +22,32 @@ DEFAULTS = {
 
 class Settings:
 
+    def __init__(self):
+        self._values = {}
+
     def __getattr__(self, attr):
         if attr not in DEFAULTS:
             raise AttributeError('Invalid setting: "{}"'.format(attr))
 
-        value = getattr(django_settings, 'DJANGO_CELERY_EXTENSIONS_{}'.format(attr), DEFAULTS[attr])
+        if attr not in self._values:
+            value = getattr(django_settings, 'DJANGO_CELERY_EXTENSIONS_{}'.format(attr), DEFAULTS[attr])
+
+            if isinstance(value, dict):
+                value = AttrDict(value)
 
-        if isinstance(value, dict):
-            value = AttrDict(value)
+            self._values[attr] = value
+        return self._values[attr]
 
-        return value
+    def reload(self):
+        self._values.clear()
 
 
 settings = Settings()
+
+
+def reload_settings(*args, **kwargs):
+    if kwargs['setting'].startswith('DJANGO_CELERY_EXTENSIONS_'):
+        settings.reload()
+
+
+setting_changed.connect(reload_settings)
@@ -1,15 +1,15 @@
 import os
 import base64
+import hashlib
 import logging
 import pickle
-
-import uuid
+import threading
 
 import import_string
 
 from datetime import timedelta
 
-from django.core.management import call_command, get_commands
+from django.core.management import call_command, get_commands, load_command_class
 from django.core.exceptions import ImproperlyConfigured
 from django.core.cache import caches
 from django.db import close_old_connections, transaction
@@ -20,28 +20,98 @@ try:
     from celery import Task, shared_task, current_app
     from celery.result import AsyncResult
     from celery.exceptions import CeleryError, TimeoutError
-    from kombu.utils import uuid as task_uuid
     from kombu import serialization
+    from kombu.utils.json import dumps as json_dumps
 except ImportError:
     raise ImproperlyConfigured('Missing celery library, please install it')
 
+try:
+    from django_redis import get_redis_connection
+    from django_redis.cache import RedisCache as DjangoRedisCache
+    from django_redis.client import DefaultClient as DjangoRedisDefaultClient
+    from redis.exceptions import ResponseError as RedisResponseError
+except ImportError:
+    DjangoRedisCache = None
+
 from .config import settings
 
 
 logger = logging.getLogger(__name__)
 
+# Redis servers older than 7 and redis-py older than 4 don't support SET NX GET command, the command is not used after
+# the first rejection
+redis_set_nx_get_supported = True
+
+django_settings_module = os.environ.get('DJANGO_SETTINGS_MODULE')
+
 
 cache = caches[settings.CACHE_NAME]
 
 
+# Random bytes for ids are read from the OS in bulk and kept per thread. The buffer must be dropped in forked
+# processes (celery prefork pool), therefore random bytes are buffered only if the fork hook is available
+random_buffer_size = 4096
+_random_buffer = threading.local()
+_use_random_buffer = hasattr(os, 'register_at_fork')
+
+
+def _reset_random_buffer():
+    global _random_buffer
+    _random_buffer = threading.local()
+
+
+if _use_random_buffer:
+    os.register_at_fork(after_in_child=_reset_random_buffer)
+
+
+def _generate_id():
+    if not _use_random_buffer:
+        return os.urandom(16).hex()
+
+    data = getattr(_random_buffer, 'data', None)
+    if not data:
+        data = _random_buffer.data = bytearray(os.urandom(random_buffer_size))
+    generated_id = data[:16].hex()
+    del data[:16]
+    return generated_id
+
+
+def _serialize_unique_key_input_to_json(task_args, task_kwargs):
+    try:
+        return json_dumps((task_args, task_kwargs), sort_keys=True, separators=(',', ':')).encode()
+    except TypeError:
+        # Dictionary keys of different types cannot be sorted
+        _, _, data = serialization.dumps((list(task_args), task_kwargs), 'json')
+        return data
+
+
+def _serialize_unique_key_input_to_pickle(task_args, task_kwargs):
+    # Fixed protocol, the unique key must be the same for all python versions
+    return pickle.dumps((list(task_args), task_kwargs), protocol=serialization.pickle_protocol)
+
+
+unique_key_input_serializers = {
+    'json': _serialize_unique_key_input_to_json,
+    'pickle': _serialize_unique_key_input_to_pickle,
+}
+
+
 def default_unique_key_generator(task, task_args, task_kwargs):
     task_args = task_args or ()
     task_kwargs = task_kwargs or {}
 
-    _, _, data = serialization.dumps(
-        (list(task_args), task_kwargs), task._get_app().conf.task_serializer,
-    )
-    return str(uuid.uuid5(uuid.NAMESPACE_DNS, ':'.join((settings.KEY_PREFIX, task.name, data))))
+    serializer = task._get_app().conf.task_serializer
+    if serializer in unique_key_input_serializers:
+        data = unique_key_input_serializers[serializer](task_args, task_kwargs)
+    else:
+        _, _, data = serialization.dumps((list(task_args), task_kwargs), serializer)
+    unique_hash = hashlib.blake2b(digest_size=16)
+    unique_hash.update(settings.KEY_PREFIX.encode())
+    unique_hash.update(b':')
+    unique_hash.update(task.name.encode())
+    unique_hash.update(b':')
+    unique_hash.update(data if isinstance(data, bytes) else data.encode())
+    return unique_hash.hexdigest()
 
 
 class NotTriggeredCeleryError(CeleryError):
@@ -50,6 +120,8 @@ class NotTriggeredCeleryError(CeleryError):
 
 class OnCommitAsyncResult:
 
+    __slots__ = ('_result',)
+
     def __init__(self):
         self._result = None
 
@@ -91,6 +163,8 @@ class OnCommitAsyncResult:
 
 class AsyncResultWrapper:
 
+    __slots__ = ('_invocation_id', '_result', '_task', '_args', '_kwargs', '_options')
+
     def __init__(self, invocation_id, result, task, args, kwargs, options):
         self._invocation_id = invocation_id
         self._result = result
@@ -141,7 +215,22 @@ class DjangoTask(Task):
     # Unique task if task with same input already exists no extra task is created and old task result is returned
     unique = False
     unique_key_generator = default_unique_key_generator
+    # Maximum number of attempts to store or read the unique task id if the cache key expires meanwhile
+    unique_task_id_max_attempts = 5
     _stackprotected = True
+    _default_retry_delays_count = 0
+    _default_retry_delays_sum = 0
+    _expires_timedelta = None
+
+    @classmethod
+    def on_bound(cls, app):
+        super().on_bound(app)
+        # Task attributes (including task annotations) are final when the task is bound to the app, therefore the
+        # values can be computed only once
+        cls._default_retry_delays_count = len(cls.default_retry_delays or ())
+        cls._default_retry_delays_sum = sum(cls.default_retry_delays or ())
+        # Task expires defined in seconds is converted to timedelta only once
+        cls._expires_timedelta = timedelta(seconds=cls.expires) if isinstance(cls.expires, (int, float)) else None
 
     @property
     def max_queue_waiting_time(self):
@@ -154,7 +243,7 @@ class DjangoTask(Task):
     def on_invocation_apply(self, invocation_id, args, kwargs, options):
         """
         Method is called when task was applied with the requester.
-        :param invocation_id: UUID of the requester invocation
+        :param invocation_id: ID of the requester invocation
         :param args: input task args
         :param kwargs: input task kwargs
         :param options: input task options
@@ -164,10 +253,10 @@ class DjangoTask(Task):
     def on_invocation_trigger(self, invocation_id, args, kwargs, task_id, options):
         """
         Task has been triggered and placed in the queue.
-        :param invocation_id: UUID of the requester invocation
+        :param invocation_id: ID of the requester invocation
         :param args: input task args
         :param kwargs: input task kwargs
-        :param task_id: UUID of the celery task
+        :param task_id: ID of the celery task
         :param options: input task options
         """
         pass
@@ -176,10 +265,10 @@ class DjangoTask(Task):
         """
         Task has been triggered but the same task is already active.
         Therefore only pointer to the active task is returned.
-        :param invocation_id: UUID of the requester invocation
+        :param invocation_id: ID of the requester invocation
         :param args: input task args
         :param kwargs: input task kwargs
-        :param task_id: UUID of the celery task
+        :param task_id: ID of the celery task
         :param options: input task options
         """
         pass
@@ -187,10 +276,10 @@ class DjangoTask(Task):
     def on_invocation_timeout(self, invocation_id, args, kwargs, task_id, ex, options):
         """
         Task has been joined to another unique async result.
-        :param invocation_id: UUID of the requester invocation
+        :param invocation_id: ID of the requester invocation
         :param args: input task args
         :param kwargs: input task kwargs
-        :param task_id: UUID of the celery task
+        :param task_id: ID of the celery task
         :param ex: celery TimeoutError
         :param options: input task options
         """
@@ -199,7 +288,7 @@ class DjangoTask(Task):
     def on_task_start(self, task_id, args, kwargs):
         """
         Task has been started with worker.
-        :param task_id: UUID of the celery task
+        :param task_id: ID of the celery task
         :param args: input task args
         :param kwargs: input task kwargs
         """
@@ -208,7 +297,7 @@ class DjangoTask(Task):
     def on_task_retry(self, task_id, args, kwargs, exc, eta):
         """
         Task failed but will be retried.
-        :param task_id: UUID of the celery task
+        :param task_id: ID of the celery task
         :param args: task args
         :param kwargs: task kwargs
         :param exc: raised exception which caused retry
@@ -219,7 +308,7 @@ class DjangoTask(Task):
     def on_task_failure(self, task_id, args, kwargs, exc, einfo):
         """
         Task failed and will not be retried.
-        :param task_id: UUID of the celery task
+        :param task_id: ID of the celery task
         :param args: task args
         :param kwargs: task kwargs
         :param exc: raised exception
@@ -230,7 +319,7 @@ class DjangoTask(Task):
     def on_task_success(self, task_id, args, kwargs, retval):
         """
         Task was successful.
-        :param task_id: UUID of the celery task
+        :param task_id: ID of the celery task
         :param args: task args
         :param kwargs: task kwargs
         :param retval: task result
@@ -275,24 +364,64 @@ class DjangoTask(Task):
     def _get_unique_key(self, task_args, task_kwargs):
         return self.unique_key_generator(task_args, task_kwargs) if self.unique else None
 
+    def _get_request_unique_key(self):
+        """
+        Unique key generated when the task was triggered is sent with the task message headers. Worker can use it
+        directly and the key needn't be generated again from the task input.
+        """
+        request = self.request
+        return getattr(request, 'unique_key', None) or (request.headers or {}).get('unique_key')
+
     def _clear_unique_key(self, task_args, task_kwarg):
-        unique_key = self._get_unique_key(task_args, task_kwarg)
+        unique_key = (
+            (self._get_request_unique_key() or self._get_unique_key(task_args, task_kwarg)) if self.unique else None
+        )
         if unique_key:
             cache.delete(unique_key)
 
-    def _get_unique_task_id(self, unique_key, task_id, stale_time_limit):
+    def _get_redis_unique_task_id(self, unique_key, task_id, stale_time_limit):
+        """
+        Store task id to the unique key or get the already stored task id with one redis command (SET NX GET).
+        The command requires Redis 7 and redis-py 4, None is returned if the command cannot be used.
+        """
+        global redis_set_nx_get_supported
+
+        try:
+            unique_task_id = get_redis_connection(settings.CACHE_NAME).set(
+                cache.make_key(unique_key), cache.client.encode(task_id), nx=True, px=int(stale_time_limit * 1000),
+                get=True
+            )
+        except RedisResponseError as ex:
+            if 'syntax error' in str(ex).lower():
+                logger.warning('Redis SET NX GET command is not supported, following exception thrown: %s', str(ex))
+                redis_set_nx_get_supported = False
+            else:
+                logger.warning('Redis SET NX GET command failed, following exception thrown: %s', str(ex))
+            return None
+        except (TypeError, NotImplementedError) as ex:
+            logger.warning('Redis SET NX GET command is not supported, following exception thrown: %s', str(ex))
+            redis_set_nx_get_supported = False
+            return None
+        return task_id if unique_task_id is None else cache.client.decode(unique_task_id)
+
+    def _get_unique_task_id(self, unique_key, task_id, stale_time_limit, task_always_eager):
         if unique_key and not stale_time_limit:
             raise CeleryError('For unique tasks is require set task stale_time_limit')
 
-        if unique_key and not self._get_app().conf.task_always_eager:
-            if cache.add(unique_key, task_id, stale_time_limit):
-                return task_id
-            else:
+        if unique_key and not task_always_eager:
+            if (redis_set_nx_get_supported and DjangoRedisCache is not None and isinstance(cache, DjangoRedisCache)
+                    and type(cache.client) is DjangoRedisDefaultClient):
+                unique_task_id = self._get_redis_unique_task_id(unique_key, task_id, stale_time_limit)
+                if unique_task_id:
+                    return unique_task_id
+
+            for _ in range(self.unique_task_id_max_attempts):
+                if cache.add(unique_key, task_id, stale_time_limit):
+                    return task_id
                 unique_task_id = cache.get(unique_key)
-                return (
-                    unique_task_id if unique_task_id
-                    else self._get_unique_task_id(unique_key, task_id, stale_time_limit)
-                )
+                if unique_task_id:
+                    return unique_task_id
+            raise CeleryError('Unique task id was not obtained from the cache')
         else:
             return task_id
 
@@ -305,21 +434,24 @@ class DjangoTask(Task):
             return trigger_time
 
     def _compute_expires(self, expires, time_limit, stale_time_limit, trigger_time):
-        expires = self.expires if expires is None else expires
+        if expires is None:
+            if self._expires_timedelta is not None:
+                return trigger_time + self._expires_timedelta
+            expires = self.expires
         if expires is not None:
-            return trigger_time + timedelta(seconds=expires) if isinstance(expires, int) else expires
+            return trigger_time + timedelta(seconds=expires) if isinstance(expires, (int, float)) else expires
         elif stale_time_limit is not None and time_limit is not None:
             return trigger_time + timedelta(seconds=stale_time_limit - time_limit)
         else:
             return None
 
-    def _get_time_limit(self, time_limit):
+    def _get_time_limit(self, time_limit, app):
         if time_limit is not None:
             return time_limit
         elif self.soft_time_limit is not None:
             return self.soft_time_limit
         else:
-            return self._get_app().conf.task_time_limit
+            return app.conf.task_time_limit
 
     def _get_stale_time_limit(self, expires, time_limit, stale_time_limit, trigger_time):
         if stale_time_limit is not None:
@@ -328,10 +460,10 @@ class DjangoTask(Task):
             return self.stale_time_limit
         elif time_limit is not None and self.max_queue_waiting_time:
             autoretry_for = getattr(self, 'autoretry_for', None)
-            if autoretry_for and self.default_retry_delays:
+            if autoretry_for and self._default_retry_delays_count:
                 return (
-                    (time_limit + self.max_queue_waiting_time) * len(self.default_retry_delays) + 1
-                    + sum(self.default_retry_delays)
+                    (time_limit + self.max_queue_waiting_time) * self._default_retry_delays_count + 1
+                    + self._default_retry_delays_sum
                 )
             elif autoretry_for:
                 return (
@@ -343,57 +475,49 @@ class DjangoTask(Task):
         else:
             return None
 
-    def _apply_and_get_wrapped_result(self, args, kwargs, invocation_id, is_async=False, **options):
-        if is_async:
-            return AsyncResultWrapper(
-                invocation_id,
-                super().apply_async(
-                    args=args, kwargs=kwargs, is_async=is_async, invocation_id=invocation_id, **options
-                ),
-                self,
-                args,
-                kwargs,
-                options
-            )
-        else:
-            return AsyncResultWrapper(
-                invocation_id,
-                super().apply(
-                    args=args, kwargs=kwargs, is_async=is_async, invocation_id=invocation_id, **options
-                ),
-                self,
-                args,
-                kwargs,
-                options
-            )
+    def _apply_and_get_wrapped_result(self, args, kwargs, invocation_id, is_async=False, unique_key=None,
+                                      **options):
+        apply_options = options
+        if unique_key:
+            apply_options = dict(options, headers=dict(options.get('headers') or {}, unique_key=unique_key))
+
+        apply_method = super().apply_async if is_async else super().apply
+        return AsyncResultWrapper(
+            invocation_id,
+            apply_method(args=args, kwargs=kwargs, is_async=is_async, invocation_id=invocation_id, **apply_options),
+            self,
+            args,
+            kwargs,
+            options
+        )
 
     def _trigger(self, args, kwargs, invocation_id, task_id=None, eta=None, countdown=None, expires=None,
-                 time_limit=None, stale_time_limit=None, is_async=True, **options):
-        app = self._get_app()
+                 time_limit=None, stale_time_limit=None, is_async=True, app=None, **options):
+        app = self._get_app() if app is None else app
 
-        task_id = task_id or task_uuid()
+        task_id = task_id or _generate_id()
 
-        time_limit = self._get_time_limit(time_limit)
+        time_limit = self._get_time_limit(time_limit, app)
         trigger_time = now()
         eta = self._compute_eta(eta, countdown, trigger_time)
         countdown = None
         stale_time_limit = self._get_stale_time_limit(expires, time_limit, stale_time_limit, trigger_time)
         expires = self._compute_expires(expires, time_limit, stale_time_limit, trigger_time)
 
-        options.update(dict(
-            invocation_id=invocation_id,
-            task_id=task_id,
-            trigger_time=trigger_time,
-            time_limit=time_limit,
-            eta=eta,
-            countdown=countdown,
-            expires=expires,
-            is_async=is_async,
-            stale_time_limit=stale_time_limit
-        ))
+        options['invocation_id'] = invocation_id
+        options['task_id'] = task_id
+        options['trigger_time'] = trigger_time
+        options['time_limit'] = time_limit
+        options['eta'] = eta
+        options['countdown'] = countdown
+        options['expires'] = expires
+        options['is_async'] = is_async
+        options['stale_time_limit'] = stale_time_limit
 
         unique_key = self._get_unique_key(args, kwargs)
-        unique_task_id = self._get_unique_task_id(unique_key, task_id, stale_time_limit)
+        unique_task_id = self._get_unique_task_id(
+            unique_key, task_id, stale_time_limit, app.conf.task_always_eager
+        )
 
         if is_async and unique_task_id != task_id:
             options['task_id'] = unique_task_id
@@ -408,24 +532,22 @@ class DjangoTask(Task):
             )
         else:
             self.on_invocation_trigger(invocation_id, args, kwargs, task_id, options)
-            return self._apply_and_get_wrapped_result(args, kwargs, **options)
+            return self._apply_and_get_wrapped_result(args, kwargs, unique_key=unique_key, **options)
 
     def _first_apply(self, args=None, kwargs=None, invocation_id=None, is_async=True, is_on_commit=False, using=None,
                      **options):
-        invocation_id = invocation_id or task_uuid()
+        invocation_id = invocation_id or _generate_id()
 
         apply_time = now()
         app = self._get_app()
         queue = str(options.get('queue', getattr(self, 'queue', app.conf.task_default_queue)))
 
-        options.update(dict(
-            queue=queue,
-            is_async=is_async,
-            invocation_id=invocation_id,
-            apply_time=apply_time,
-            is_on_commit=is_on_commit,
-            using=using,
-        ))
+        options['queue'] = queue
+        options['is_async'] = is_async
+        options['invocation_id'] = invocation_id
+        options['apply_time'] = apply_time
+        options['is_on_commit'] = is_on_commit
+        options['using'] = using
         self.on_invocation_apply(invocation_id, args, kwargs, options)
 
         if is_on_commit:
@@ -433,12 +555,12 @@ class DjangoTask(Task):
             self_inst = self
 
             def _apply_on_commit():
-                result = self_inst._trigger(args=args, kwargs=kwargs, **options)
+                result = self_inst._trigger(args=args, kwargs=kwargs, app=app, **options)
                 on_commit_result.set_result(result)
             transaction.on_commit(_apply_on_commit, using=using)
             return on_commit_result
         else:
-            return self._trigger(args=args, kwargs=kwargs, **options)
+            return self._trigger(args=args, kwargs=kwargs, app=app, **options)
 
     def apply_async_on_commit(self, args=None, kwargs=None, using=None, **options):
         return self._first_apply(args=args, kwargs=kwargs, is_async=True, is_on_commit=True, using=using, **options)
@@ -451,7 +573,8 @@ class DjangoTask(Task):
 
     def apply_async(self, args=None, kwargs=None, **options):
         try:
-            if self.request.id:
+            req = self.request_stack.top
+            if req is not None and req.id:
                 return super().apply_async(args=args, kwargs=kwargs, **options)
             else:
                 return self._first_apply(
@@ -510,11 +633,19 @@ class DjangoTask(Task):
 
 
 def obj_to_string(obj):
-    return base64.encodebytes(pickle.dumps(obj)).decode('utf8')
+    return base64.b64encode(pickle.dumps(obj, protocol=serialization.pickle_protocol)).decode('ascii')
 
 
 def string_to_obj(obj_string):
-    return pickle.loads(base64.decodebytes(obj_string.encode('utf8')))
+    return pickle.loads(base64.b64decode(obj_string))
+
+
+def obj_to_bytes(obj):
+    return pickle.dumps(obj, protocol=serialization.pickle_protocol)
+
+
+def bytes_to_obj(obj_bytes):
+    return pickle.loads(obj_bytes)
 
 
 def get_django_command_task(command_name):
@@ -526,17 +657,24 @@ def get_django_command_task(command_name):
 
 
 def auto_convert_commands_to_tasks():
-    for name in get_commands():
-        if name in settings.AUTO_GENERATE_TASKS_DJANGO_COMMANDS:
-            def generate_command_task(command_name):
+    django_commands = settings.AUTO_GENERATE_TASKS_DJANGO_COMMANDS
+    if not django_commands:
+        return
+
+    base = import_string(settings.AUTO_GENERATE_TASKS_BASE)
+    default_celery_kwargs = settings.AUTO_GENERATE_TASKS_DEFAULT_CELERY_KWARGS
+    commands = get_commands()
+    for name in django_commands:
+        if name in commands:
+            def generate_command_task(command_name, command_app_name):
                 shared_task_kwargs = dict(
-                    base=import_string(settings.AUTO_GENERATE_TASKS_BASE),
+                    base=base,
                     bind=True,
                     name=command_name,
                     ignore_result=True,
-                    **settings.AUTO_GENERATE_TASKS_DEFAULT_CELERY_KWARGS
+                    **default_celery_kwargs
                 )
-                shared_task_kwargs.update(settings.AUTO_GENERATE_TASKS_DJANGO_COMMANDS[command_name])
+                shared_task_kwargs.update(django_commands[command_name])
 
                 @shared_task(
                     **shared_task_kwargs
@@ -544,10 +682,10 @@ def auto_convert_commands_to_tasks():
                 def command_task(self, command_args=None, **kwargs):
                     command_args = [] if command_args is None else command_args
                     call_command(
-                        command_name,
-                        settings=os.environ.get('DJANGO_SETTINGS_MODULE'),
+                        load_command_class(command_app_name, command_name),
                         *command_args,
+                        settings=django_settings_module,
                         **self.get_command_kwargs()
                     )
 
-            generate_command_task(name)
+            generate_command_task(name, commands[name])
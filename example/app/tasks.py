@@ -39,3 +39,12 @@ def retry_task(self):
     unique=True)
 def unique_task(self):
     return 'unique'
+
+
+@celery_app.task(
+    base=DjangoTask,
+    bind=True,
+    name='expires_task',
+    expires=60 * 60)
+def expires_task(self):
+    return 'expires'
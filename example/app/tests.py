@@ -1,9 +1,13 @@
+from contextlib import contextmanager
 from datetime import timedelta
 
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+from celery import Celery
 from celery.exceptions import CeleryError, TimeoutError
 
+from kombu import serialization
+
 from django.contrib.auth.models import User
 from django.test import override_settings
 from django.utils.timezone import now
@@ -16,13 +20,18 @@ from germanium.tools import (
 
 from freezegun import freeze_time
 
-from app.tasks import error_task, retry_task, sum_task, unique_task
+from app.tasks import error_task, expires_task, retry_task, sum_task, unique_task
 
 from django_celery_extensions.task import (
-    get_django_command_task, default_unique_key_generator, NotTriggeredCeleryError, AsyncResultWrapper
+    get_django_command_task, default_unique_key_generator, NotTriggeredCeleryError, AsyncResultWrapper,
+    obj_to_string, string_to_obj, obj_to_bytes, bytes_to_obj, _generate_id, DjangoTask
 )
 
 
+class RedisResponseError(Exception):
+    pass
+
+
 class DjangoCeleryExtensionsTestCase(GermaniumTestCase):
 
     @override_settings(DJANGO_CELERY_EXTENSIONS_DEFAULT_TASK_STALE_TIME_LIMIT=None)
@@ -68,18 +77,36 @@ class DjangoCeleryExtensionsTestCase(GermaniumTestCase):
 
     @override_settings(DJANGO_CELERY_EXTENSIONS_DEFAULT_TASK_MAX_QUEUE_WAITING_TIME=1)
     def test_default_unique_key_generator_should_generate_unique_id_for_same_input(self):
-        assert_equal(default_unique_key_generator(unique_task, None, None), '4718e7b8-12eb-51b7-a8fb-5a98dbdf20a1')
-        assert_equal(default_unique_key_generator(sum_task, None, None), '57cd2e1f-1f40-5848-a88b-ba0124e09497')
-        assert_equal(default_unique_key_generator(unique_task, (), None), '4718e7b8-12eb-51b7-a8fb-5a98dbdf20a1')
-        assert_equal(default_unique_key_generator(unique_task, None, {}), '4718e7b8-12eb-51b7-a8fb-5a98dbdf20a1')
-        assert_equal(default_unique_key_generator(unique_task, (), {}), '4718e7b8-12eb-51b7-a8fb-5a98dbdf20a1')
+        assert_equal(default_unique_key_generator(unique_task, None, None), '0841122f4e8db0e8dd3c682a309a3832')
+        assert_equal(default_unique_key_generator(sum_task, None, None), '265a84d42f65c7aab3e6c6e8eb43ea63')
+        assert_equal(default_unique_key_generator(unique_task, (), None), '0841122f4e8db0e8dd3c682a309a3832')
+        assert_equal(default_unique_key_generator(unique_task, None, {}), '0841122f4e8db0e8dd3c682a309a3832')
+        assert_equal(default_unique_key_generator(unique_task, (), {}), '0841122f4e8db0e8dd3c682a309a3832')
         assert_equal(
             default_unique_key_generator(unique_task, ('test', ), None),
-            'c89e99de-559c-5dac-b247-58ae40afc123'
+            'e96cc6ac868003c884a411a19f62fe3f'
         )
         assert_equal(
             default_unique_key_generator(unique_task, None, {'test': ['test', 'test']}),
-            '00918486-5d65-5713-846f-7a3b75539a52'
+            'c3a9a6b279ddcc351cd65cc2dc189451'
+        )
+
+    def test_default_unique_key_generator_should_support_dictionary_keys_of_different_types(self):
+        with patch('django_celery_extensions.task.serialization.dumps', wraps=serialization.dumps) as mocked_dumps:
+            assert_equal(
+                default_unique_key_generator(unique_task, None, {'d': {1: 'a', 'b': 2}}),
+                '369a73d09f6e6f038c6e8e8967dd0a56'
+            )
+            mocked_dumps.assert_called_once()
+
+    def test_default_unique_key_generator_should_not_depend_on_kwargs_order(self):
+        assert_equal(
+            default_unique_key_generator(unique_task, None, {'a': 1, 'b': 2}),
+            '58c3971b06dd84ed5fc61e6be22995e8'
+        )
+        assert_equal(
+            default_unique_key_generator(unique_task, None, {'b': 2, 'a': 1}),
+            '58c3971b06dd84ed5fc61e6be22995e8'
         )
 
     @override_settings(DJANGO_CELERY_EXTENSIONS_DEFAULT_TASK_MAX_QUEUE_WAITING_TIME=1)
@@ -292,3 +319,173 @@ class DjangoCeleryExtensionsTestCase(GermaniumTestCase):
                 assert_equal(
                     call_args[0], ('test task', None, None, call_args[0][3], now() + timedelta(seconds=delay))
                 )
+
+    def test_obj_to_string_should_be_reversible_with_string_to_obj(self):
+        obj = {'test': [1, 'test', (2, 3)], 'data': b'test' * 100}
+        obj_string = obj_to_string(obj)
+        assert_true(isinstance(obj_string, str))
+        assert_true('\n' not in obj_string)
+        assert_equal(string_to_obj(obj_string), obj)
+
+    def test_obj_to_bytes_should_be_reversible_with_bytes_to_obj(self):
+        obj = {'test': [1, 'test', (2, 3)], 'data': b'test' * 100}
+        obj_bytes = obj_to_bytes(obj)
+        assert_true(isinstance(obj_bytes, bytes))
+        assert_true(len(obj_bytes) < len(obj_to_string(obj)))
+        assert_equal(bytes_to_obj(obj_bytes), obj)
+
+    @override_settings(DJANGO_CELERY_EXTENSIONS_DEFAULT_TASK_STALE_TIME_LIMIT=5)
+    def test_unique_key_should_be_generated_only_once_per_task_run(self):
+        with patch.object(unique_task, 'unique_key_generator', return_value='unique-key') as mocked_generator:
+            assert_equal(unique_task.apply_async_and_get_result(), 'unique')
+            mocked_generator.assert_called_once()
+
+    @override_settings(CELERY_ALWAYS_EAGER=False, DJANGO_CELERY_EXTENSIONS_DEFAULT_TASK_STALE_TIME_LIMIT=5)
+    def test_unique_task_id_should_be_obtained_with_limited_number_of_cache_attempts(self):
+        with patch('django_celery_extensions.task.cache') as mocked_cache:
+            mocked_cache.add.return_value = False
+            mocked_cache.get.return_value = None
+            with assert_raises(CeleryError):
+                unique_task.apply_async()
+            assert_equal(mocked_cache.add.call_count, unique_task.unique_task_id_max_attempts)
+
+    @override_settings(DJANGO_CELERY_EXTENSIONS_DEFAULT_TASK_MAX_QUEUE_WAITING_TIME=1)
+    def test_stale_time_limit_should_be_computed_from_default_retry_delays(self):
+        assert_equal(
+            retry_task._get_stale_time_limit(None, 300, None, now()),
+            301 * 5 + 1 + (1 * 60 + 5 * 60 + 10 * 60 + 30 * 60 + 60 * 60)
+        )
+
+    def test_task_and_invocation_ids_should_be_generated_for_applied_task(self):
+        with patch.object(sum_task, 'on_invocation_trigger') as mocked_method:
+            sum_task.apply_async(args=(1, 2))
+            invocation_id, _, _, task_id, _ = mocked_method.call_args[0]
+            assert_equal(len(invocation_id), 32)
+            assert_equal(len(task_id), 32)
+            assert_true(invocation_id != task_id)
+
+    def test_generated_ids_should_be_unique(self):
+        generated_ids = {_generate_id() for _ in range(1000)}
+        assert_equal(len(generated_ids), 1000)
+        assert_true(all(len(generated_id) == 32 for generated_id in generated_ids))
+
+    def test_generated_ids_should_not_be_buffered_without_fork_hook(self):
+        with patch('django_celery_extensions.task._use_random_buffer', False):
+            with patch('django_celery_extensions.task.os.urandom', return_value=b'\x01' * 16) as mocked_urandom:
+                assert_equal(_generate_id(), '01' * 16)
+                mocked_urandom.assert_called_once_with(16)
+
+    @freeze_time(now())
+    def test_task_expires_should_be_computed_from_task_or_apply_expires(self):
+        with patch.object(expires_task, 'on_invocation_trigger') as mocked_method:
+            expires_task.apply_async()
+            assert_equal(mocked_method.call_args[0][4]['expires'], now() + timedelta(seconds=60 * 60))
+
+            expires_task.apply_async(expires=10)
+            assert_equal(mocked_method.call_args[0][4]['expires'], now() + timedelta(seconds=10))
+
+            expires_task.apply_async(expires=1.5)
+            assert_equal(mocked_method.call_args[0][4]['expires'], now() + timedelta(seconds=1.5))
+
+            expires_at = now() + timedelta(days=1)
+            expires_task.apply_async(expires=expires_at)
+            assert_equal(mocked_method.call_args[0][4]['expires'], expires_at)
+
+    @override_settings(DJANGO_CELERY_EXTENSIONS_DEFAULT_TASK_MAX_QUEUE_WAITING_TIME=1)
+    def test_stale_time_limit_should_be_computed_from_annotated_default_retry_delays(self):
+        app = Celery('annotated', set_as_current=False)
+        app.conf.task_annotations = {'annotated_retry_task': {'default_retry_delays': (1, 2)}}
+
+        @app.task(
+            base=DjangoTask,
+            bind=True,
+            name='annotated_retry_task',
+            autoretry_for=(RuntimeError,),
+            default_retry_delays=(10, 20, 30))
+        def annotated_retry_task(self):
+            return 'annotated'
+
+        assert_equal(annotated_retry_task.default_retry_delays, (1, 2))
+        assert_equal(annotated_retry_task._get_stale_time_limit(None, 300, None, now()), 301 * 2 + 1 + 3)
+
+    @freeze_time(now())
+    def test_task_expires_should_be_computed_from_annotated_expires(self):
+        app = Celery('annotated', set_as_current=False)
+        app.conf.task_annotations = {'annotated_expires_task': {'expires': 5}}
+
+        @app.task(
+            base=DjangoTask,
+            bind=True,
+            name='annotated_expires_task',
+            expires=60 * 60)
+        def annotated_expires_task(self):
+            return 'annotated'
+
+        assert_equal(annotated_expires_task.expires, 5)
+        assert_equal(annotated_expires_task._compute_expires(None, None, None, now()), now() + timedelta(seconds=5))
+
+    @contextmanager
+    def _mock_django_redis_cache(self, client_class=None):
+        class DefaultClient:
+
+            def encode(self, value):
+                return value.encode()
+
+            def decode(self, value):
+                return value.decode()
+
+        mocked_cache = MagicMock()
+        mocked_cache.make_key.side_effect = lambda key: 'prefix:{}'.format(key)
+        mocked_cache.client = (client_class or DefaultClient)()
+        mocked_cache.add.return_value = True
+        mocked_connection = MagicMock()
+        mocked_connection.set.return_value = None
+
+        with patch('django_celery_extensions.task.cache', mocked_cache), \
+                patch('django_celery_extensions.task.DjangoRedisCache', MagicMock), \
+                patch('django_celery_extensions.task.DjangoRedisDefaultClient', DefaultClient, create=True), \
+                patch('django_celery_extensions.task.RedisResponseError', RedisResponseError, create=True), \
+                patch('django_celery_extensions.task.redis_set_nx_get_supported', True), \
+                patch('django_celery_extensions.task.get_redis_connection', create=True) as mocked_get_connection:
+            mocked_get_connection.return_value = mocked_connection
+            yield mocked_cache, mocked_connection
+
+    def test_unique_task_id_should_be_obtained_with_redis_set_nx_get_command(self):
+        with self._mock_django_redis_cache() as (mocked_cache, mocked_connection):
+            assert_equal(unique_task._get_unique_task_id('key', 'new task', 5, False), 'new task')
+            mocked_connection.set.assert_called_with('prefix:key', b'new task', nx=True, px=5000, get=True)
+
+            mocked_connection.set.return_value = b'existing task'
+            assert_equal(unique_task._get_unique_task_id('key', 'new task', 5, False), 'existing task')
+            mocked_cache.add.assert_not_called()
+
+    def test_unique_task_id_should_not_be_obtained_with_redis_set_nx_get_command_for_not_default_client(self):
+        class ShardClient:
+            pass
+
+        with self._mock_django_redis_cache(ShardClient) as (mocked_cache, mocked_connection):
+            assert_equal(unique_task._get_unique_task_id('key', 'new task', 5, False), 'new task')
+            mocked_connection.set.assert_not_called()
+            mocked_cache.add.assert_called_once()
+
+    def test_unique_task_id_should_be_obtained_with_cache_add_if_redis_set_nx_get_command_is_not_supported(self):
+        for ex in (RedisResponseError('ERR syntax error'), TypeError('unexpected keyword argument'),
+                   NotImplementedError()):
+            with self._mock_django_redis_cache() as (mocked_cache, mocked_connection):
+                mocked_connection.set.side_effect = ex
+                assert_equal(unique_task._get_unique_task_id('key', 'new task', 5, False), 'new task')
+                assert_equal(unique_task._get_unique_task_id('key', 'new task', 5, False), 'new task')
+                assert_equal(mocked_connection.set.call_count, 1)
+                assert_equal(mocked_cache.add.call_count, 2)
+
+    def test_unique_task_id_should_be_obtained_with_cache_add_if_redis_set_nx_get_command_failed(self):
+        with self._mock_django_redis_cache() as (mocked_cache, mocked_connection):
+            mocked_connection.set.side_effect = RedisResponseError('OOM command not allowed')
+            assert_equal(unique_task._get_unique_task_id('key', 'new task', 5, False), 'new task')
+            assert_equal(mocked_cache.add.call_count, 1)
+
+            mocked_connection.set.side_effect = None
+            mocked_connection.set.return_value = b'existing task'
+            assert_equal(unique_task._get_unique_task_id('key', 'new task', 5, False), 'existing task')
+            assert_equal(mocked_connection.set.call_count, 2)
+            assert_equal(mocked_cache.add.call_count, 1)